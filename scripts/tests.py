@@ -30,17 +30,45 @@ has been run).
 """
 
 import os
+import re
 import sys
 import json
+import mmap
+import struct
 import shutil
 import fnmatch
+import functools
 import hashlib
+import operator
+import itertools
 import argparse
+import tempfile
+import concurrent.futures
 import subprocess
 
+try:
+    # Faster, but optional.
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 
 _script_dir = os.path.dirname(os.path.realpath(__file__))
 
+# Checksums are only compared against each other, so any fast hash will do.
+_hasher = functools.partial(hashlib.blake2b, digest_size=16)
+
+# Outputs smaller than this are kept in memory and compared byte for byte
+# instead of being hashed.
+_small_file_size = 1024 * 1024
+
+# The values that ducible replaces timestamps and PDB ages with. These must be
+# kept in sync with src/pe/pe.h.
+_canonical_timestamp = 1262304000
+_canonical_pdb_age = 1
+
+_msf_magic = b'Microsoft C/C++ MSF 7.00\r\n\x1a\x44\x53\0\0\0'
+
 class MismatchException(Exception):
     """
     Thrown when a checksum mismatch is detected in a test case.
@@ -59,188 +87,510 @@ class Test:
         self.args = args
         self.clean_files = clean_files
 
-    def run(self, bin_dir):
+        # Match all the clean patterns with a single regex. Like
+        # fnmatch.fnmatch, this is case insensitive on Windows.
+        self._clean_re = re.compile('|'.join(
+            '(?:%s)' % fnmatch.translate(os.path.normcase(p))
+            for p in clean_files)) if clean_files else None
+
+    def is_clean_file(self, name):
         """
-        Runs a single test.
+        Returns True if the given file name matches one of the clean patterns.
+        """
+        return bool(self._clean_re and
+                    self._clean_re.match(os.path.normcase(name)))
 
-        Throws an exception if the test failed.
+    def run(self, bin_dir, parallel=False, fast=False, verbose=False):
         """
+        Runs a single test. `bin_dir` must be an absolute path, as the build
+        runs in the test's directory.
+
+        If `parallel` is True, both rounds are built at the same time in
+        separate copies of the test directory. This only works for tests whose
+        outputs do not depend on the directory they are built in.
+
+        If `fast` is True, the second round is skipped when the timestamps and
+        PDB ages in the outputs of the first round are already the values that
+        ducible is supposed to write. ducible always writes these values, so
+        this only checks that ducible ran. It does not test reproducibility.
+
+        The output of the build commands is only shown if `verbose` is True or
+        if a command fails.
+
+        Returns True if the second round was skipped. Throws an exception if
+        the test failed.
+        """
+
+        if parallel and fast:
+            raise ValueError('parallel and fast cannot be used together')
 
-        bin_dir = os.path.abspath(bin_dir)
         ducible = os.path.join(bin_dir, 'ducible')
 
-        outputs = [os.path.join(self.workdir, o) for o in self.args]
+        if parallel:
+            checksums_1, checksums_2 = self._run_parallel(ducible, verbose)
+        else:
+            checksums_1 = self._round(ducible, self.workdir, verbose)
 
-        # Run the commands to do the build
-        for command in self.commands:
-            subprocess.check_call(command, cwd=self.workdir)
+            if fast and all(is_canonical(os.path.join(self.workdir, o))
+                            for o in self.args):
+                print('Second round skipped (--fast)')
+                self.clean()
+                return True
 
-        # Attempt to eliminate nondeterminism
-        subprocess.check_call([ducible] + self.args, cwd=self.workdir)
+            self.clean()
 
-        checksums_1 = [hash_file(o).digest() for o in outputs]
+            checksums_2 = self._round(ducible, self.workdir, verbose)
+            self.clean()
 
-        self.clean()
+        if checksums_1 == checksums_2:
+            return False
 
-        # Run the commands to do the build (again)
-        for command in self.commands:
-            subprocess.check_call(command, cwd=self.workdir)
+        mismatches = itertools.compress(self.args,
+                map(operator.ne, checksums_1, checksums_2))
 
-        # Attempt to eliminate nondeterminism (again)
-        subprocess.check_call([ducible] + self.args, cwd=self.workdir)
+        print('Error: The following files are not reproducible:')
+        for m in mismatches:
+            print('  {}'.format(m))
 
-        checksums_2 = [hash_file(o).digest() for o in outputs]
+        raise MismatchException('Some files are not reproducible')
 
-        self.clean()
+    def _round(self, ducible, workdir, verbose):
+        """
+        Does one build in the given directory and returns the checksums of
+        the outputs.
+        """
 
-        mismatches = [i for i,c in enumerate(zip(checksums_1, checksums_2))
-                        if c[0] != c[1]]
+        # Run the commands to do the build
+        for command in self.commands:
+            run_command(command, workdir, verbose)
 
-        if mismatches:
-            print('Error: The following files are not reproducible:')
-            for m in mismatches:
-                print('  {}'.format(self.args[m]))
+        # Attempt to eliminate nondeterminism
+        run_command([ducible] + self.args, workdir, verbose)
 
-            raise MismatchException('Some files are not reproducible')
+        return checksums([os.path.join(workdir, o) for o in self.args])
 
-    def analyze(self, bin_dir):
+    def _run_parallel(self, ducible, verbose):
+        """
+        Does both rounds at the same time, each in its own copy of the test
+        directory. Returns the checksums of both rounds.
+        """
+
+        ignore = shutil.ignore_patterns('analysis', *self.clean_files)
+
+        scratch = tempfile.mkdtemp(prefix='ducible-{}-'.format(self.name))
+        try:
+            workdirs = [os.path.join(scratch, str(i)) for i in (1, 2)]
+            for d in workdirs:
+                shutil.copytree(self.workdir, d, ignore=ignore)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as ex:
+                rounds = [ex.submit(self._round, ducible, d, verbose)
+                          for d in workdirs]
+                return [r.result() for r in rounds]
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def analyze(self, bin_dir, verbose=False):
         """
         Creates an environment to make analyzing non-determinism easier.
 
         In particular, it creates a hexdump of all files and puts them
-        side-by-side in the test's directory for easy diffing.
+        side-by-side in the test's directory for easy diffing. `bin_dir` must
+        be an absolute path.
         """
 
-        bin_dir = os.path.abspath(bin_dir)
         ducible = os.path.join(bin_dir, 'ducible')
         pdbdump = os.path.join(bin_dir, 'pdbdump')
         analysis = os.path.join(self.workdir, 'analysis')
 
         os.makedirs(analysis, exist_ok=True)
 
+        for n in (1, 2):
+            self._analyze_round(n, ducible, pdbdump, analysis, verbose)
+            self.clean()
+
+        # Copy the analyze script there for convenience
+        shutil.copy(os.path.join(_script_dir, 'analyze'), analysis)
+
+    def _analyze_round(self, n, ducible, pdbdump, analysis, verbose):
+        """
+        Does one build, saving the outputs and PDB dumps from before and after
+        running ducible in the analysis directory.
+        """
+
         outputs = [os.path.join(self.workdir, o) for o in self.args]
         pdbs = [o for o in outputs if os.path.splitext(o)[1] == '.pdb']
 
+        def analysis_path(path, suffix):
+            return os.path.join(analysis,
+                    '{}.{}.{}'.format(os.path.basename(path), n, suffix))
+
+        def dump_pdbs(suffix):
+            for pdb in pdbs:
+                with open(analysis_path(pdb, suffix + '.pdbdump'), 'w') as f:
+                    subprocess.check_call([pdbdump, '--verbose', '--', pdb],
+                            stdout=f)
+
         # Run the commands to do the build
         for command in self.commands:
-            subprocess.check_call(command, cwd=self.workdir)
+            run_command(command, self.workdir, verbose)
 
-        # Copy *original* outputs to the analysis directory (round 1)
+        # Copy *original* outputs to the analysis directory. ducible patches
+        # images in place, so only the PDBs, which it replaces with a new file,
+        # can be hard linked.
         for o in outputs:
-            shutil.copyfile(o, os.path.join(analysis,
-                os.path.basename(o)+'.1.orig'))
+            snapshot(o, analysis_path(o, 'orig'), link=o in pdbs)
 
-        # Dump the *original* PDBs (round 1)
-        for pdb in pdbs:
-            output = os.path.join(analysis, os.path.basename(o)+'.1.orig.pdbdump')
-            with open(output, 'w') as f:
-                subprocess.check_call([pdbdump, '--verbose', '--', pdb], stdout=f)
+        # Dump the *original* PDBs
+        dump_pdbs('orig')
 
         # Attempt to eliminate nondeterminism
-        subprocess.check_call([ducible] + self.args, cwd=self.workdir)
+        run_command([ducible] + self.args, self.workdir, verbose)
 
-        # Copy *rewritten* outputs to the analysis directory (round 1)
-        for o in outputs:
-            shutil.copyfile(o, os.path.join(analysis,
-                os.path.basename(o)+'.1.rewritten'))
+        # Dump the *rewritten* PDBs
+        dump_pdbs('rewritten')
 
-        # Dump the *rewritten* PDBs (round 1)
-        for pdb in pdbs:
-            output = os.path.join(analysis, os.path.basename(o)+'.1.rewritten.pdbdump')
-            with open(output, 'w') as f:
-                subprocess.check_call([pdbdump, '--verbose', '--', pdb], stdout=f)
+        # Move *rewritten* outputs to the analysis directory. They would be
+        # deleted by the clean step anyway.
+        for o in outputs:
+            os.replace(o, analysis_path(o, 'rewritten'))
 
-        self.clean()
+    def inputs(self):
+        """
+        Returns the paths, relative to the test's directory, of the files that
+        the test's build reads. These are test.json and the files tracked by
+        Git. Returns None if Git can't list them.
+        """
+        try:
+            tracked = subprocess.check_output(
+                    ['git', 'ls-files', '-z', '--', '.'], cwd=self.workdir,
+                    stderr=subprocess.DEVNULL, encoding='utf-8').split('\0')
+        except (OSError, subprocess.CalledProcessError):
+            return None
 
-        # Run the commands to do the build (again)
-        for command in self.commands:
-            subprocess.check_call(command, cwd=self.workdir)
+        # Build byproducts that aren't cleaned, such as the .lib and .exp files
+        # MSVC leaves behind, are not tracked and so are left out.
+        paths = set(p for p in tracked if p)
+        paths.add('test.json')
 
-        # Copy *original* outputs to the analysis directory (round 2)
-        for o in outputs:
-            shutil.copyfile(o, os.path.join(analysis,
-                os.path.basename(o)+'.2.orig'))
+        return sorted(p for p in paths
+                      if os.path.isfile(os.path.join(self.workdir, p)))
 
-        # Dump the *original* PDBs (round 2)
-        for pdb in pdbs:
-            output = os.path.join(analysis, os.path.basename(o)+'.2.orig.pdbdump')
-            with open(output, 'w') as f:
-                subprocess.check_call([pdbdump, '--verbose', '--', pdb], stdout=f)
+    def fingerprint(self, ducible_mtime):
+        """
+        Returns a string that changes whenever the test's configuration, its
+        inputs, the ducible executable, or the build tools change. Returns None
+        if the inputs can't be determined.
+        """
+        inputs = self.inputs()
+        if inputs is None:
+            return None
 
-        # Attempt to eliminate nondeterminism (again)
-        subprocess.check_call([ducible] + self.args, cwd=self.workdir)
+        hasher = _hasher()
 
-        # Copy *rewritten* outputs to the analysis directory (round 2)
-        for o in outputs:
-            shutil.copyfile(o, os.path.join(analysis,
-                os.path.basename(o)+'.2.rewritten'))
+        # The outputs being tested come from the build tools, so an update to
+        # them or a different Visual Studio environment must invalidate the
+        # cache too.
+        tools = []
+        for command in self.commands:
+            path = shutil.which(command[0])
+            tools.append([path, os.stat(path).st_mtime_ns if path else None])
 
-        # Dump the *rewritten* PDBs (round 2)
-        for pdb in pdbs:
-            output = os.path.join(analysis, os.path.basename(o)+'.2.rewritten.pdbdump')
-            with open(output, 'w') as f:
-                subprocess.check_call([pdbdump, '--verbose', '--', pdb], stdout=f)
+        hasher.update(json.dumps(
+            [self.commands, self.args, self.clean_files, ducible_mtime,
+             os.environ.get('VisualStudioVersion'), tools]
+            ).encode('utf-8'))
 
-        self.clean()
+        for path in inputs:
+            hasher.update(path.encode('utf-8') + b'\0')
+            hasher.update(hash_file(os.path.join(self.workdir, path)).digest())
 
-        # Copy the analyze script there for convenience
-        shutil.copy(os.path.join(_script_dir, 'analyze'), analysis)
+        return hasher.hexdigest()
 
     def clean(self):
         """
         Deletes the files specified in the 'clean' array.
         """
-        root, dirs, files = next(os.walk(self.workdir))
+        with os.scandir(self.workdir) as it:
+            for entry in it:
+                if entry.is_file() and self.is_clean_file(entry.name):
+                    print('Deleting \'%s\'' % entry.name)
+                    os.remove(entry.path)
 
-        for f in files:
-            for pattern in self.clean_files:
-                if fnmatch.fnmatch(f, pattern):
-                    print('Deleting \'%s\'' % f)
-                    os.remove(os.path.join(root, f))
+def snapshot(src, dst, link=True):
+    """
+    Makes `dst` a copy of `src`. If `link` is True, a hard link is made
+    instead, falling back to a copy if that isn't possible. Only link files
+    that won't be modified in place afterwards.
+    """
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
 
-def hash_file(path, chunk_size=65536):
-    hasher = hashlib.md5()
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
 
-    buf = bytearray(chunk_size)
+def run_command(command, cwd, verbose=False):
+    """
+    Runs a build command. Unless `verbose` is True, its output is captured and
+    only printed if the command fails.
+    """
+    if verbose:
+        subprocess.check_call(command, cwd=cwd)
+        return
 
+    try:
+        subprocess.check_output(command, cwd=cwd, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        sys.stdout.write(e.output.decode('utf-8', errors='replace'))
+        raise
+
+def pe_is_canonical(path):
+    """
+    Returns True if the timestamp and checksum in the headers of the given PE
+    file have been replaced by ducible.
+    """
     with open(path, 'rb') as f:
+        dos_header = f.read(64)
+        if len(dos_header) < 64 or dos_header[:2] != b'MZ':
+            return False
+
+        f.seek(struct.unpack_from('<I', dos_header, 0x3C)[0])
+
+        # PE signature, file header, and the optional header up to and
+        # including the checksum.
+        headers = f.read(4 + 20 + 68)
+        if len(headers) < 4 + 20 + 68 or headers[:4] != b'PE\0\0':
+            return False
+
+    timestamp, = struct.unpack_from('<I', headers, 4 + 4)
+    checksum, = struct.unpack_from('<I', headers, 4 + 20 + 64)
+
+    return timestamp == _canonical_timestamp and checksum == _canonical_timestamp
+
+def _page_count(size, page_size):
+    return (size + page_size - 1) // page_size
+
+def _read_pages(f, pages, page_size):
+    data = bytearray()
+    for page in pages:
+        f.seek(page * page_size)
+        data += f.read(page_size)
+    return data
+
+def pdb_is_canonical(path):
+    """
+    Returns True if the timestamp and age in the PDB stream of the given PDB
+    file have been replaced by ducible.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(52)
+        if len(header) < 52 or header[:32] != _msf_magic:
+            return False
+
+        page_size, _, _, table_size, _ = struct.unpack_from('<IIIIi', header, 32)
+        if page_size == 0:
+            return False
+
+        # Read the list of pages that make up the stream table. That list is
+        # itself spread across the pages listed after the header.
+        table_pages = _page_count(table_size, page_size)
+        table_pages_pages = _page_count(table_pages * 4, page_size)
+
+        f.seek(52)
+        data = f.read(table_pages_pages * 4)
+        if len(data) < table_pages_pages * 4:
+            return False
+
+        data = _read_pages(f, struct.unpack('<%dI' % table_pages_pages, data),
+                page_size)
+        table = _read_pages(f, struct.unpack_from('<%dI' % table_pages, data),
+                page_size)[:table_size]
+
+        stream_count, = struct.unpack_from('<I', table)
+        if stream_count < 2:
+            return False
+
+        sizes = struct.unpack_from('<%dI' % stream_count, table, 4)
+
+        # The page list of the PDB stream (stream 1) comes right after the
+        # page list of stream 0. Unused streams have a size of -1.
+        offset = 4 + 4 * stream_count
+        if sizes[0] != 0xFFFFFFFF:
+            offset += 4 * _page_count(sizes[0], page_size)
+
+        if sizes[1] == 0xFFFFFFFF or sizes[1] < 12:
+            return False
+
+        first_page, = struct.unpack_from('<I', table, offset)
+
+        f.seek(first_page * page_size)
+        stream = f.read(12)
+        if len(stream) < 12:
+            return False
+
+    _, timestamp, age = struct.unpack('<III', stream)
+
+    return timestamp == _canonical_timestamp and age == _canonical_pdb_age
+
+def is_canonical(path):
+    """
+    Returns True if the given output has had its nondeterministic header
+    fields replaced by ducible. Returns False if this can't be determined for
+    this type of file or if the file is malformed.
+    """
+    ext = os.path.splitext(path)[1].lower()
+
+    try:
+        if ext in ('.dll', '.exe'):
+            return pe_is_canonical(path)
+        elif ext == '.pdb':
+            return pdb_is_canonical(path)
+    except (struct.error, ValueError, OverflowError, OSError):
+        pass
+
+    return False
+
+def hash_file(path, chunk_size=1024*1024):
+    hasher = _hasher()
+
+    with open(path, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files cannot be mapped. Fall back to reading in chunks.
+            m = None
+
+        if m is not None:
+            with m:
+                hasher.update(m)
+            return hasher
+
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+
         while True:
             read = f.readinto(buf)
-            if read == 0:
+            if not read:
                 break
-            hasher.update(buf[0:read])
+            hasher.update(view[:read])
 
     return hasher
 
+def checksum(path):
+    """
+    Returns a value that can be compared with `==` to tell whether two files
+    have the same contents. Small files are compared directly rather than by
+    hashing them.
+    """
+    if os.path.getsize(path) < _small_file_size:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    return hash_file(path).digest()
+
+def checksums(paths):
+    """
+    Returns the checksums of the given files, computing them in parallel.
+    """
+    if not paths:
+        return []
+
+    workers = min(len(paths), os.cpu_count() or 1)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+        return list(ex.map(checksum, paths))
+
 
 def tests(tests_dir):
     """
     Yields test objects to be executed.
     """
-    root, dirs, files = next(os.walk(tests_dir))
+    with os.scandir(tests_dir) as it:
+        dirs = [e for e in it if e.is_dir()]
 
     for d in dirs:
-        try:
-            with open(os.path.join(root, d, 'test.json')) as f:
-                obj = json.load(f)
-                yield Test(d, os.path.join(root, d),
-                        obj['commands'],
-                        obj['ducible_args'],
-                        obj['clean'])
-        except FileNotFoundError:
-            # Directory doesn't have a test in it
-            pass
+        config = os.path.join(d.path, 'test.json')
 
-def run_all_tests(tests_dir, bin_dir):
+        # Skip directories that don't have a test in them
+        if not os.path.isfile(config):
+            continue
+
+        with open(config, 'rb') as f:
+            obj = _json_loads(f.read())
+
+        yield Test(d.name, d.path,
+                obj['commands'],
+                obj['ducible_args'],
+                obj['clean'])
+
+def load_cache(path):
+    """
+    Loads the fingerprints of previously passing tests.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+
+def run_all_tests(tests_dir, bin_dir, parallel=False, fast=False,
+        verbose=False, cache_path=None):
     failed = 0
 
+    cache = load_cache(cache_path) if cache_path else {}
+
+    bin_dir = os.path.abspath(bin_dir)
+
+    # Any change to ducible itself invalidates all cached results.
+    ducible = os.path.join(bin_dir, 'ducible')
+    try:
+        ducible_mtime = os.stat(shutil.which(ducible) or ducible).st_mtime_ns
+    except OSError:
+        ducible_mtime = None
+
     for t in tests(tests_dir):
         print(':: Running test "{}"...'.format(t.name))
+
+        # Forget the previous result unless it turns out to still be valid.
+        previous = cache.pop(t.name, None)
+
         try:
-            t.run(bin_dir)
+            fingerprint = None
+            if cache_path and ducible_mtime is not None:
+                fingerprint = t.fingerprint(ducible_mtime)
+                if fingerprint is not None and previous == fingerprint:
+                    cache[t.name] = fingerprint
+                    print('Cached, skipping')
+                    continue
+
+            skipped = t.run(bin_dir, parallel=parallel, fast=fast,
+                    verbose=verbose)
+
+            # Skipping the second round is too weak a check to be remembered
+            # as a pass. The fingerprint must also be the same as before the
+            # build, or the next run could never match it.
+            if fingerprint and not skipped:
+                if t.fingerprint(ducible_mtime) == fingerprint:
+                    cache[t.name] = fingerprint
+                else:
+                    print('Warning: The build changed the test\'s inputs,'
+                          ' not caching the result')
+
         except MismatchException as e:
             print('Mismatch detected, re-running test for analysis...')
-            t.analyze(bin_dir)
+            t.analyze(bin_dir, verbose=verbose)
 
             failed += 1
             print('TEST FAILED:', e)
@@ -249,6 +599,9 @@ def run_all_tests(tests_dir, bin_dir):
             failed += 1
             print('TEST FAILED:', e)
 
+    if cache_path:
+        save_cache(cache_path, cache)
+
     return failed
 
 if __name__ == '__main__':
@@ -256,14 +609,34 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Runs tests')
     parser.add_argument('bindir',
             help='Directory of the Ducible and Pdbdump executables.')
+    parser.add_argument('--parallel', action='store_true',
+            help='Build both rounds of each test at the same time in separate'
+                 ' directories. Only use this if the outputs do not depend on'
+                 ' the build directory.')
+    parser.add_argument('--fast', action='store_true',
+            help='Skip the second build of a test if ducible has replaced the'
+                 ' timestamps and PDB ages in its outputs. This only checks'
+                 ' that ducible ran; it does NOT test reproducibility.')
+    parser.add_argument('--verbose', action='store_true',
+            help='Show the output of the build commands.')
+    parser.add_argument('--no-cache', action='store_true',
+            help='Run all tests, even those that passed before and have not'
+                 ' changed since.')
     args = parser.parse_args()
 
+    if args.parallel and args.fast:
+        parser.error('--parallel and --fast cannot be used together')
+
     assert os.environ['VisualStudioVersion'] == '14.0',\
             'You must be in a Visual Studio 2015 command prompt.'
 
     tests_dir = os.path.relpath(os.path.join(_script_dir, '../tests'))
 
-    failed = run_all_tests(tests_dir, args.bindir)
+    cache_path = None if args.no_cache else os.path.join(_script_dir,
+            '.test_cache.json')
+
+    failed = run_all_tests(tests_dir, args.bindir, parallel=args.parallel,
+            fast=args.fast, verbose=args.verbose, cache_path=cache_path)
     if failed > 0:
         print(':: %s test(s) failed' % failed)
         sys.exit(1)
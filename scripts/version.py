@@ -31,10 +31,11 @@ import subprocess
 import argparse
 import functools
 
-from typing import Any
+from typing import Any, NamedTuple
 
-@functools.total_ordering
-class SemVer(object):
+_re_macro = re.compile(r'\${([^}]*)}')
+
+class SemVer(NamedTuple):
     """
     Represents a semantic version of the form:
 
@@ -44,22 +45,21 @@ class SemVer(object):
     of this script.
     """
 
-    def __init__(self, major: int, minor: int, patch: int, pre_release: str = ""):
-        self.major = major
-        self.minor = minor
-        self.patch = patch
-        self.pre_release = pre_release
+    major: int
+    minor: int
+    patch: int
+    pre_release: str = ""
 
-    @staticmethod
-    def parse(s) -> Any:
+    @classmethod
+    def parse(cls, s) -> Any:
         components = s.split("-")
         major, minor, patch = [int(x) for x in components[0].split(".")]
         if len(components) > 1:
             pre_release = components[1]
         else:
-            pre_release = None
+            pre_release = ""
 
-        return SemVer(major, minor, patch, pre_release)
+        return cls(major, minor, patch, pre_release)
 
     def __str__(self) -> str:
         if self.pre_release:
@@ -72,54 +72,37 @@ class SemVer(object):
     def __repr__(self) -> str:
         return str(self)
 
-    def __hash__(self) -> int:
-        return hash((self.major, self.minor, self.patch, self.pre_release))
-
-    def __le__(self, other: Any) -> bool:
-        if not isinstance(other, SemVer):
-            return NotImplemented
-
-        return (self.major, self.minor, self.patch, self.pre_release) < (
-            other.major,
-            other.minor,
-            other.patch,
-            other.pre_release,
-        )
-
-    def __eq__(self, other: Any) -> bool:
-        if not isinstance(other, SemVer):
-            return NotImplemented
-
-        return (self.major, self.minor, self.patch, self.pre_release) == (
-            other.major,
-            other.minor,
-            other.patch,
-            other.pre_release,
-        )
+@functools.lru_cache(maxsize=None)
+def git_describe():
+    """
+    Returns the output of `git describe --always --dirty` for the current
+    repository.
+    """
+    return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            encoding='utf-8').strip()
 
 def git_version():
     """
     Returns a short Git commit hash for the current repository.
     """
-    return subprocess.check_output(['git', 'describe', '--always', '--dirty']) \
-            .decode('utf-8')\
-            .strip()
+    return git_describe()
 
 def git_commit_short():
     """
     Returns a short Git commit hash for the current repository.
     """
-    return subprocess.check_output(['git', 'describe', '--always']) \
-            .decode('utf-8')\
-            .strip()
+    version = git_describe()
+    if version.endswith('-dirty'):
+        version = version[:-len('-dirty')]
+    return version
 
+@functools.lru_cache(maxsize=None)
 def git_commit_long():
     """
     Returns a full length Git commit hash for the current repository.
     """
-    return subprocess.check_output(['git', 'rev-parse', 'HEAD']) \
-            .decode('utf-8')\
-            .strip()
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            encoding='utf-8').strip()
 
 def version_info(version_file):
     """
@@ -143,13 +126,22 @@ def substitute_variables(input_file, output_file, variables):
 
     content = input_file.read()
 
-    re_macro = re.compile(r'\${([^}]*)}')
+    # Turn the ${NAME} macros into {NAME} format fields, escaping any other
+    # braces so that the whole file can be expanded with a single format call.
+    parts = _re_macro.split(content)
+    names = parts[1::2]
+    parts[0::2] = [p.replace('{', '{{').replace('}', '}}') for p in parts[0::2]]
+    parts[1::2] = ['{' + p + '}' for p in names]
 
     try:
-        output_file.write(re_macro.sub(
-            lambda m: str(variables[m.group(1)]),
-            content
-        ))
+        # Anything other than a plain identifier would be interpreted by the
+        # formatter as an index, attribute, conversion, or format spec. No
+        # such variable can be defined.
+        for name in names:
+            if not name.isidentifier():
+                raise KeyError(name)
+
+        output_file.write(''.join(parts).format_map(variables))
     except KeyError as e:
         print('Variable %s is not defined' % e, file=sys.stderr)
         sys.exit(1)